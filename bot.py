@@ -1,11 +1,20 @@
 import os
+import re
+import asyncio
+import time
+import hashlib
 import logging
-from typing import List, Dict, Optional
+import weakref
+from collections import OrderedDict, deque
+from contextlib import aclosing
+from typing import AsyncIterator, Deque, Dict, Iterable, Optional, Tuple
 import httpx
+import orjson
 
 from dotenv import load_dotenv
-from telegram import Update, ReplyKeyboardMarkup, ReplyKeyboardRemove
+from telegram import Message, Update, ReplyKeyboardMarkup, ReplyKeyboardRemove
 from telegram.ext import (
+    AIORateLimiter,
     ApplicationBuilder,
     ContextTypes,
     CommandHandler,
@@ -28,29 +37,140 @@ logger = logging.getLogger(__name__)
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 BOT_USERNAME = os.getenv("BOT_USERNAME", "genz_mediator_bot").lower()
+MENTION_RE = re.compile(rf"@{re.escape(BOT_USERNAME)}\b", re.IGNORECASE)
 
 # Conversation states
 CHATTING = 1
 
+# Number of recent group messages kept per chat for analysis
+RECENT_MSGS_LIMIT = 10
+
+# How long a group analysis is reused for an unchanged conversation
+ANALYSIS_DEDUP_TTL = 60.0
+
+# Number of private chat turns kept per user (last 3 exchanges)
+CHAT_HISTORY_LIMIT = 6
+
 # Gemini API configuration - Updated to use gemini-2.0-flash
-GEMINI_API_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash:generateContent"
-HEADERS = {"Content-Type": "application/json"}
+GEMINI_BASE_URL = "https://generativelanguage.googleapis.com"
+GEMINI_STREAM_PATH = "/v1beta/models/gemini-2.0-flash:streamGenerateContent"
 
-async def generate_gemini_response(prompt: str, chat_history: List[Dict] = None) -> str:
-    """Generate response using Gemini API with gemini-2.0-flash model"""
-    if chat_history is None:
-        chat_history = []
-    
-    contents = []
-    
-    # Add chat history if available
-    for msg in chat_history:
-        if msg['role'] == 'user':
-            contents.append({"role": "user", "parts": [{"text": msg['content']}]})
-        else:
-            contents.append({"role": "model", "parts": [{"text": msg['content']}]})
-    
-    # Add current prompt
+# Per-group budget for outgoing Telegram requests, enforced by AIORateLimiter
+TELEGRAM_GROUP_MAX_RATE = 20
+TELEGRAM_GROUP_TIME_PERIOD = 60
+
+# Minimum seconds between edits of a streamed reply. Group edits are spaced to
+# fit the rate limiter's group budget so streaming never queues behind it.
+PRIVATE_STREAM_EDIT_INTERVAL = 1.0
+GROUP_STREAM_EDIT_INTERVAL = TELEGRAM_GROUP_TIME_PERIOD / TELEGRAM_GROUP_MAX_RATE
+
+# Static mediator instructions, sent as systemInstruction so the prompt prefix
+# stays byte-identical across calls and can hit Gemini's implicit prefix cache
+MEDIATOR_SYSTEM_PROMPT = (
+    "You are an unbiased, emotionally intelligent AI mediator. "
+    "Given these group messages, provide:\n"
+    "1. A short, neutral summary\n"
+    "2. An unbiased suggestion\n"
+    "Format strictly as:\n"
+    "Summary: <summary>\n"
+    "Suggestion: <suggestion>"
+)
+MEDIATOR_PROMPT_PREFIX = "Messages:\n"
+
+# Static reply texts, built once at import
+WELCOME_TEMPLATE = (
+    "👋 Hi {first_name}! I'm your AI Mediator Bot powered by Gemini Flash.\n\n"
+    f"In groups, mention me (@{BOT_USERNAME}) to analyze conversations.\n\n"
+    "Commands available:\n"
+    "/help - Show help message\n"
+    "/chat - Start a conversation\n"
+    "/stop - End conversation"
+)
+HELP_TEXT = (
+    "🤖 <b>AI Mediator Bot Help</b> 🤖\n\n"
+    "<b>Group Chat Features:</b>\n"
+    f"- Mention me (@{BOT_USERNAME}) to analyze recent messages\n"
+    "- I'll provide neutral summaries and suggestions\n\n"
+    "<b>Private Chat Commands:</b>\n"
+    "/start - Welcome message\n"
+    "/help - Show this help\n"
+    "/chat - Start 1-on-1 conversation\n"
+    "/stop - End conversation\n\n"
+    "Powered by Google's Gemini Flash (Free Version)"
+)
+
+# Shared HTTP/2 client so concurrent Gemini calls multiplex over kept-alive
+# connections (HTTP/2 requires the h2 package). Headers and the API key are
+# attached once here instead of being merged into every request.
+GEMINI_CLIENT = httpx.AsyncClient(
+    base_url=GEMINI_BASE_URL,
+    headers={"Content-Type": "application/json"},
+    params={"alt": "sse", "key": GEMINI_API_KEY},
+    http2=True,
+    timeout=httpx.Timeout(connect=5.0, read=30.0, write=10.0, pool=5.0),
+    limits=httpx.Limits(
+        max_connections=128,
+        max_keepalive_connections=32,
+        keepalive_expiry=60.0
+    )
+)
+
+GEMINI_ERROR_MESSAGE = "⚠️ Sorry, I encountered an error. Please try again later."
+
+class GeminiError(Exception):
+    """Raised by generate_gemini_response when no usable reply could be produced.
+
+    The message is the user-facing error text.
+    """
+
+# Transport errors (timeouts, dropped connections) get one retry after a backoff
+GEMINI_MAX_ATTEMPTS = 2
+GEMINI_RETRY_BACKOFF = 0.5
+
+# Bound on concurrent Gemini requests across all chats
+GEMINI_SEM = asyncio.Semaphore(24)
+
+# Per-chat locks keep replies ordered within a chat while other chats proceed.
+# Held weakly, so a chat's lock is dropped once nobody holds or waits on it.
+_CHAT_LOCKS: "weakref.WeakValueDictionary[int, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+def _get_chat_lock(chat_id: int) -> asyncio.Lock:
+    """Returns the lock serializing Gemini work for a chat."""
+    return _CHAT_LOCKS.setdefault(chat_id, asyncio.Lock())
+
+# In-memory LRU cache of Gemini replies keyed by request payload hash
+RESPONSE_CACHE_TTL = 300.0
+RESPONSE_CACHE_MAX_SIZE = 1024
+_RESPONSE_CACHE: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+
+def _get_cached_response(key: str) -> Optional[str]:
+    """Returns a cached reply if present and not expired."""
+    entry = _RESPONSE_CACHE.get(key)
+    if entry is None:
+        return None
+    stored_at, text = entry
+    if time.monotonic() - stored_at > RESPONSE_CACHE_TTL:
+        del _RESPONSE_CACHE[key]
+        return None
+    _RESPONSE_CACHE.move_to_end(key)
+    return text
+
+def _store_cached_response(key: str, text: str) -> None:
+    """Stores a reply, evicting the least recently used entry when full."""
+    _RESPONSE_CACHE[key] = (time.monotonic(), text)
+    _RESPONSE_CACHE.move_to_end(key)
+    if len(_RESPONSE_CACHE) > RESPONSE_CACHE_MAX_SIZE:
+        _RESPONSE_CACHE.popitem(last=False)
+
+async def generate_gemini_response(
+    prompt: str,
+    chat_history: Optional[Iterable[Dict]] = None,
+    system_instruction: Optional[str] = None
+) -> AsyncIterator[str]:
+    """Stream a response from the Gemini API with gemini-2.0-flash model"""
+    # Chat history is stored in Gemini's wire format (oldest -> newest, never
+    # reordered), so it is sent as-is with the current prompt appended
+    contents = list(chat_history) if chat_history else []
     contents.append({"role": "user", "parts": [{"text": prompt}]})
     
     data = {
@@ -60,91 +180,160 @@ async def generate_gemini_response(prompt: str, chat_history: List[Dict] = None)
             "maxOutputTokens": 500
         }
     }
+    if system_instruction:
+        data["systemInstruction"] = {"parts": [{"text": system_instruction}]}
     
-    try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"{GEMINI_API_URL}?key={GEMINI_API_KEY}",
-                headers=HEADERS,
-                json=data,
-                timeout=30.0
-            )
+    # Keys are sorted on serialization so identical requests are byte-identical
+    payload = orjson.dumps(data, option=orjson.OPT_SORT_KEYS)
+    cache_key = hashlib.blake2b(payload, digest_size=16).hexdigest()
+    cached = _get_cached_response(cache_key)
+    if cached is not None:
+        yield cached
+        return
+    
+    parts = []
+    for attempt in range(GEMINI_MAX_ATTEMPTS):
+        try:
+            async with GEMINI_SEM:
+                async with GEMINI_CLIENT.stream(
+                    "POST",
+                    GEMINI_STREAM_PATH,
+                    content=payload
+                ) as response:
+                    if response.status_code != 200:
+                        body = (await response.aread()).decode(errors="replace")
+                        logger.error(f"Gemini API Error: {body}")
+                        raise GeminiError(f"⚠️ API Error (Status: {response.status_code}): {body}")
+                    
+                    # Server-sent events: one JSON chunk per "data:" line
+                    async for line in response.aiter_lines():
+                        if not line.startswith("data:"):
+                            continue
+                        chunk = orjson.loads(line[5:])
+                        if 'candidates' in chunk and chunk['candidates']:
+                            for part in chunk['candidates'][0].get('content', {}).get('parts', []):
+                                if text := part.get('text'):
+                                    parts.append(text)
+                                    yield text
+            break
+        
+        except httpx.TransportError as e:
+            # Timeouts and connection failures are retried, but only before any
+            # text has reached the user
+            if parts or attempt + 1 == GEMINI_MAX_ATTEMPTS:
+                logger.error(f"Request Error: {str(e)}")
+                raise GeminiError(GEMINI_ERROR_MESSAGE) from e
+            logger.warning(f"Retrying Gemini request after error: {str(e)}")
+            await asyncio.sleep(GEMINI_RETRY_BACKOFF * 2 ** attempt)
             
-            if response.status_code == 200:
-                result = response.json()
-                if 'candidates' in result and result['candidates']:
-                    return result['candidates'][0]['content']['parts'][0]['text']
-                return "Sorry, I couldn't generate a response."
-            else:
-                logger.error(f"Gemini API Error: {response.text}")
-                return f"⚠️ API Error (Status: {response.status_code}): {response.text}"
-                
-    except Exception as e:
-        logger.error(f"Request Error: {str(e)}")
-        return "⚠️ Sorry, I encountered an error. Please try again later."
+        except (httpx.HTTPError, orjson.JSONDecodeError) as e:
+            logger.error(f"Request Error: {str(e)}")
+            raise GeminiError(GEMINI_ERROR_MESSAGE) from e
+    
+    full_text = "".join(parts)
+    if not full_text.strip():
+        raise GeminiError("Sorry, I couldn't generate a response.")
+    _store_cached_response(cache_key, full_text)
+
+async def reply_streaming(
+    message: Message,
+    chunks: AsyncIterator[str],
+    edit_interval: float,
+    **kwargs
+) -> Optional[str]:
+    """Replies with a placeholder and edits it as streamed text arrives.
+
+    Returns the full reply text, or None if generation failed; the error is
+    then shown in the placeholder instead.
+    """
+    parts = []
+    
+    async def read_stream() -> None:
+        # Drained in its own task so a slow Telegram edit never holds the
+        # Gemini semaphore slot or the open HTTP stream
+        async with aclosing(chunks) as stream:
+            async for chunk in stream:
+                parts.append(chunk)
+    
+    # Start the Gemini request before the placeholder round trip so neither
+    # waits on the other
+    reader = asyncio.create_task(read_stream())
+    shown = ""
+    try:
+        reply = await message.reply_text("…", **kwargs)
+        while True:
+            # Merge everything that arrived during the interval into one edit;
+            # the interval only starts counting once the previous edit is done
+            done, _ = await asyncio.wait({reader}, timeout=edit_interval)
+            if done:
+                break
+            # Telegram trims trailing whitespace, so a whitespace-only delta
+            # would be rejected as "message is not modified"
+            text = "".join(parts).rstrip()
+            if text and text != shown:
+                await reply.edit_text(text)
+                shown = text
+    finally:
+        # Stop reading right away if a send failed or we were cancelled
+        reader.cancel()
+    
+    text = "".join(parts).rstrip()
+    try:
+        reader.result()
+    except GeminiError as e:
+        error = str(e)
+    except Exception:
+        logger.exception("Unexpected error while streaming Gemini response")
+        error = GEMINI_ERROR_MESSAGE
+    else:
+        # Flush whatever arrived after the last edit
+        if text != shown:
+            await reply.edit_text(text)
+        return text
+    
+    # Keep any partial answer, clearly separated from the error
+    await reply.edit_text(f"{text}\n\n{error}" if text else error)
+    return None
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Send a welcome message when the command /start is issued."""
     user = update.effective_user
-    welcome_message = (
-        f"👋 Hi {user.first_name}! I'm your AI Mediator Bot powered by Gemini Flash.\n\n"
-        f"In groups, mention me (@{BOT_USERNAME}) to analyze conversations.\n\n"
-        "Commands available:\n"
-        "/help - Show help message\n"
-        "/chat - Start a conversation\n"
-        "/stop - End conversation"
-    )
-    await update.message.reply_text(welcome_message)
+    await update.message.reply_text(WELCOME_TEMPLATE.format(first_name=user.first_name))
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Send a help message when the command /help is issued."""
-    help_text = (
-        "🤖 <b>AI Mediator Bot Help</b> 🤖\n\n"
-        "<b>Group Chat Features:</b>\n"
-        f"- Mention me (@{BOT_USERNAME}) to analyze recent messages\n"
-        "- I'll provide neutral summaries and suggestions\n\n"
-        "<b>Private Chat Commands:</b>\n"
-        "/start - Welcome message\n"
-        "/help - Show this help\n"
-        "/chat - Start 1-on-1 conversation\n"
-        "/stop - End conversation\n\n"
-        "Powered by Google's Gemini Flash (Free Version)"
-    )
-    await update.message.reply_text(help_text, parse_mode='HTML')
-
-async def analyze_conversation(messages: List[str]) -> str:
-    """Analyzes group messages and returns a summary + suggestion."""
-    prompt = (
-        "You are an unbiased, emotionally intelligent AI mediator. "
-        "Given these group messages, provide:\n"
-        "1. A short, neutral summary\n"
-        "2. An unbiased suggestion\n"
-        "Format strictly as:\n"
-        "Summary: <summary>\n"
-        "Suggestion: <suggestion>\n"
-        "Messages:\n" + "\n".join(messages[-10:])
-    )
+    await update.message.reply_text(HELP_TEXT, parse_mode='HTML')
+
+def analyze_conversation(messages: Iterable[str]) -> AsyncIterator[str]:
+    """Analyzes group messages and streams a summary + suggestion."""
+    prompt = MEDIATOR_PROMPT_PREFIX + "\n".join(messages)
     
-    return await generate_gemini_response(prompt)
+    return generate_gemini_response(
+        prompt,
+        system_instruction=MEDIATOR_SYSTEM_PROMPT
+    )
 
 async def chat_with_ai(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Starts a conversation with the AI."""
-    context.user_data["chat_history"] = []
-    await update.message.reply_text(
-        "💬 You're now chatting with Gemini Flash AI. Send me any message!\n"
-        "Type /stop to end the chat.",
-        reply_markup=ReplyKeyboardRemove()
-    )
+    async with _get_chat_lock(update.effective_chat.id):
+        context.user_data["chat_history"] = deque(maxlen=CHAT_HISTORY_LIMIT)
+        await update.message.reply_text(
+            "💬 You're now chatting with Gemini Flash AI. Send me any message!\n"
+            "Type /stop to end the chat.",
+            reply_markup=ReplyKeyboardRemove()
+        )
     return CHATTING
 
 async def stop_chat(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Ends the conversation with the AI."""
-    if "chat_history" in context.user_data:
-        del context.user_data["chat_history"]
-    await update.message.reply_text(
-        "👍 Chat ended. Start again with /chat!",
-        reply_markup=ReplyKeyboardRemove()
-    )
+    # Wait for any in-flight reply so its CHATTING state can't override END
+    async with _get_chat_lock(update.effective_chat.id):
+        if "chat_history" in context.user_data:
+            del context.user_data["chat_history"]
+        await update.message.reply_text(
+            "👍 Chat ended. Start again with /chat!",
+            reply_markup=ReplyKeyboardRemove()
+        )
     return ConversationHandler.END
 
 async def handle_ai_response(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -152,23 +341,24 @@ async def handle_ai_response(update: Update, context: ContextTypes.DEFAULT_TYPE)
     try:
         user_message = update.message.text
         
-        await context.bot.send_chat_action(
-            chat_id=update.effective_chat.id, 
-            action="typing"
-        )
-        
-        # Get or initialize chat history
-        chat_history = context.user_data.get("chat_history", [])
-        
-        # Generate response
-        response = await generate_gemini_response(user_message, chat_history)
-        
-        # Update chat history
-        chat_history.append({"role": "user", "content": user_message})
-        chat_history.append({"role": "model", "content": response})
-        context.user_data["chat_history"] = chat_history[-6:]  # Keep last 3 exchanges
-        
-        await update.message.reply_text(response)
+        async with _get_chat_lock(update.effective_chat.id):
+            # A /stop that got the lock first has already ended this chat;
+            # don't reply or the returned state would reopen it
+            chat_history = context.user_data.get("chat_history")
+            if chat_history is None:
+                return ConversationHandler.END
+            
+            # Stream response into the reply as it is generated
+            response = await reply_streaming(
+                update.message,
+                generate_gemini_response(user_message, chat_history),
+                PRIVATE_STREAM_EDIT_INTERVAL
+            )
+            
+            # Update chat history; failed turns are left out
+            if response is not None:
+                chat_history.append({"role": "user", "parts": [{"text": user_message}]})
+                chat_history.append({"role": "model", "parts": [{"text": response}]})
         
         return CHATTING
         
@@ -177,13 +367,26 @@ async def handle_ai_response(update: Update, context: ContextTypes.DEFAULT_TYPE)
         await update.message.reply_text("⚠️ An error occurred. Please try again.")
         return CHATTING
 
+def _get_recent_msgs(context: ContextTypes.DEFAULT_TYPE) -> Deque[str]:
+    """Returns the chat's bounded recent-message buffer, creating it if needed."""
+    chat_history = context.chat_data.get("recent_msgs")
+    if chat_history is None:
+        chat_history = deque(maxlen=RECENT_MSGS_LIMIT)
+        context.chat_data["recent_msgs"] = chat_history
+    return chat_history
+
 async def cache_messages(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Caches recent group messages for context."""
     if message := update.effective_message:
         if text := message.text:
-            chat_history = context.chat_data.setdefault("recent_msgs", [])
+            chat_history = _get_recent_msgs(context)
             chat_history.append(f"{message.from_user.first_name}: {text}")
-            context.chat_data["recent_msgs"] = chat_history[-10:]
+
+class BotMentionFilter(filters.MessageFilter):
+    """Matches messages that mention this bot by username."""
+
+    def filter(self, message) -> bool:
+        return bool(message.text and MENTION_RE.search(message.text))
 
 async def handle_group_mention(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handles when bot is mentioned in a group."""
@@ -192,25 +395,45 @@ async def handle_group_mention(update: Update, context: ContextTypes.DEFAULT_TYP
         if not message or not message.text or not update.effective_chat:
             return
 
-        if f"@{BOT_USERNAME}" not in message.text.lower():
-            return
-
-        await context.bot.send_chat_action(
-            chat_id=update.effective_chat.id, 
-            action="typing"
-        )
+        async with _get_chat_lock(update.effective_chat.id):
+            # cache_messages (handler group 0) has already recorded this message
+            chat_history = _get_recent_msgs(context)
 
-        chat_history = context.chat_data.get("recent_msgs", [])
-        chat_history.append(f"{message.from_user.first_name}: {message.text}")
-        context.chat_data["recent_msgs"] = chat_history[-10:]
+            # Repeat mentions over an unchanged conversation reuse the last analysis.
+            # Mentions (including this one) are left out of the fingerprint, since
+            # each new mention would otherwise change it.
+            conversation = "\n".join(m for m in chat_history if not MENTION_RE.search(m))
+            key = hashlib.blake2b(conversation.encode(), digest_size=16).digest()
+            last_at = context.chat_data.get("last_analysis_at", 0.0)
+            if (
+                context.chat_data.get("last_analysis_key") == key
+                and time.monotonic() - last_at <= ANALYSIS_DEDUP_TTL
+            ):
+                await message.reply_text(
+                    context.chat_data["last_analysis"],
+                    reply_to_message_id=message.message_id
+                )
+                return
 
-        analysis = await analyze_conversation(chat_history)
-        await message.reply_text(analysis, reply_to_message_id=message.message_id)
+            analysis = await reply_streaming(
+                message,
+                analyze_conversation(chat_history),
+                GROUP_STREAM_EDIT_INTERVAL,
+                reply_to_message_id=message.message_id
+            )
+            if analysis is not None:
+                context.chat_data["last_analysis_key"] = key
+                context.chat_data["last_analysis_at"] = time.monotonic()
+                context.chat_data["last_analysis"] = analysis
 
     except Exception as e:
         logger.error(f"Group error: {e}")
         await update.effective_message.reply_text("⚠️ Error processing request.")
 
+async def close_gemini_client(app) -> None:
+    """Closes the shared Gemini HTTP client on shutdown."""
+    await GEMINI_CLIENT.aclose()
+
 def main():
     """Run the bot."""
     if not TELEGRAM_BOT_TOKEN:
@@ -220,7 +443,29 @@ def main():
         logger.error("Missing GEMINI_API_KEY in .env")
         return
 
-    app = ApplicationBuilder().token(TELEGRAM_BOT_TOKEN).build()
+    app = (
+        ApplicationBuilder()
+        .token(TELEGRAM_BOT_TOKEN)
+        # Smooth reply bursts under Telegram's flood limits (needs the
+        # python-telegram-bot[rate-limiter] extra)
+        .rate_limiter(
+            AIORateLimiter(
+                group_max_rate=TELEGRAM_GROUP_MAX_RATE,
+                group_time_period=TELEGRAM_GROUP_TIME_PERIOD,
+                max_retries=3
+            )
+        )
+        # Separate pools so long-polling getUpdates never starves outbound sends
+        .connection_pool_size(256)
+        .pool_timeout(20.0)
+        .get_updates_connection_pool_size(4)
+        .get_updates_pool_timeout(30.0)
+        # Process updates concurrently; per-chat locks keep each chat ordered,
+        # and handle_ai_response bails out if /stop ran while it was waiting
+        .concurrent_updates(True)
+        .post_shutdown(close_gemini_client)
+        .build()
+    )
 
     # Command handlers
     app.add_handler(CommandHandler("start", start))
@@ -238,18 +483,20 @@ def main():
     )
     app.add_handler(conv_handler)
 
-    # Group message handlers
+    # Group message handlers: cache every message first, then analyze mentions
     app.add_handler(
         MessageHandler(
             filters.ChatType.GROUPS & filters.TEXT & ~filters.COMMAND,
             cache_messages
-        )
+        ),
+        group=0
     )
     app.add_handler(
         MessageHandler(
-            filters.ChatType.GROUPS & filters.TEXT & filters.Entity("mention"),
+            filters.ChatType.GROUPS & filters.TEXT & ~filters.COMMAND & BotMentionFilter(),
             handle_group_mention
-        )
+        ),
+        group=1
     )
 
     logger.info("🤖 Gemini Flash-powered bot is running...")